@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import datetime
 import json
 import logging
@@ -10,8 +11,38 @@ import time
 import auto_irida_uploader.config
 import auto_irida_uploader.core as core
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 DEFAULT_SCAN_INTERVAL_SECONDS = 3600.0
 
+DEFAULT_UPLOAD_CONCURRENCY = 1
+
+REQUIRED_RUN_KEYS = frozenset([
+    'sequencing_run_id',
+    'path',
+    'instrument_type',
+])
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Log formatter that serializes dict log messages to json. Serialization only happens
+    when a record is actually emitted, so messages that are filtered out by the log level
+    are never serialized. If orjson is installed, it's used in place of the json module.
+    """
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            record = logging.makeLogRecord(record.__dict__)
+            if orjson is not None:
+                record.msg = orjson.dumps(record.msg).decode()
+            else:
+                record.msg = json.dumps(record.msg)
+        return super().format(record)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config')
@@ -25,15 +56,19 @@ def main():
     except AttributeError as e:
         log_level = logging.INFO
 
-    logging.basicConfig(
-        format='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module", "%(module)s", "function_name": "%(funcName)s", "line_num", %(lineno)d, "message": %(message)s}',
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(JsonFormatter(
+        fmt='{"timestamp": "%(asctime)s.%(msecs)03d", "level": "%(levelname)s", "module", "%(module)s", "function_name": "%(funcName)s", "line_num", %(lineno)d, "message": %(message)s}',
         datefmt='%Y-%m-%dT%H:%M:%S',
-        encoding='utf-8',
+    ))
+    logging.basicConfig(
+        handlers=[log_handler],
         level=log_level,
     )
-    logging.debug(json.dumps({"event_type": "debug_logging_enabled"}))
+    logging.debug({"event_type": "debug_logging_enabled"})
 
     quit_when_safe = False
+    config_mtime_ns = None
 
     while(True):
         if quit_when_safe:
@@ -41,35 +76,56 @@ def main():
         try:
             if args.config:
                 try:
+                    config_mtime_ns = os.stat(args.config).st_mtime_ns
                     config = auto_irida_uploader.config.load_config(args.config)
-                    logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
+                    logging.info({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)})
                 except json.decoder.JSONDecodeError as e:
                     # If we fail to load the config file, we continue on with the
                     # last valid config that was loaded.
-                    logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
+                    logging.error({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)})
+
+            upload_concurrency = DEFAULT_UPLOAD_CONCURRENCY
+            if "upload_concurrency" in config:
+                try:
+                    upload_concurrency = max(1, int(str(config['upload_concurrency'])))
+                except ValueError as e:
+                    upload_concurrency = DEFAULT_UPLOAD_CONCURRENCY
 
             scan_start_timestamp = datetime.datetime.now()
-            for run in core.scan(config):
-                required_run_keys = [
-                    'sequencing_run_id',
-                    'path',
-                    'instrument_type',
-                ]
-                if run is not None and all([k in run for k in required_run_keys]):
-                    try:
-                        config = auto_irida_uploader.config.load_config(args.config)
-                        logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                    except json.decoder.JSONDecodeError as e:
-                        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
-                    sample_list_is_valid = core.validate_samplelist(config, run)
-                    if sample_list_is_valid:
-                        core.upload_run(config, run)
-                if quit_when_safe:
-                    exit(0)
+            # Uploads run in the background, so that we can continue scanning (and checksumming)
+            # the next run while the current one is being uploaded. The number of uploads in
+            # progress is bounded, so that the scan never gets too far ahead of the uploads.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=upload_concurrency) as upload_executor:
+                uploads_in_progress = set()
+                for run in core.scan(config):
+                    if run is not None and REQUIRED_RUN_KEYS.issubset(run):
+                        # Pick up any changes to the config file made since the scan started,
+                        # without re-loading it for every run if it hasn't changed.
+                        if args.config and os.stat(args.config).st_mtime_ns != config_mtime_ns:
+                            try:
+                                config_mtime_ns = os.stat(args.config).st_mtime_ns
+                                config = auto_irida_uploader.config.load_config(args.config)
+                                logging.info({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)})
+                            except json.decoder.JSONDecodeError as e:
+                                logging.error({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)})
+                        sample_list_is_valid = core.validate_samplelist(config, run)
+                        if sample_list_is_valid:
+                            if len(uploads_in_progress) >= upload_concurrency:
+                                uploads_completed, uploads_in_progress = concurrent.futures.wait(
+                                    uploads_in_progress,
+                                    return_when=concurrent.futures.FIRST_COMPLETED,
+                                )
+                                for upload in uploads_completed:
+                                    upload.result()
+                            uploads_in_progress.add(upload_executor.submit(core.upload_run, config, run))
+                    if quit_when_safe:
+                        exit(0)
+                for upload in concurrent.futures.as_completed(uploads_in_progress):
+                    upload.result()
             scan_complete_timestamp = datetime.datetime.now()
             scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
             scan_duration_seconds = scan_duration_delta.total_seconds()
-            logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
+            logging.info({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds})
 
             if quit_when_safe:
                 exit(0)
@@ -82,7 +138,7 @@ def main():
                     scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
             time.sleep(scan_interval)
         except KeyboardInterrupt as e:
-            logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
+            logging.info({"event_type": "quit_when_safe_enabled"})
             quit_when_safe = True
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+
+from typing import Optional
+
+_log = logging.getLogger(__name__)
+
+# Maximum number of files kept in a cache. Entries are kept in least-recently-used
+# order, and the least-recently-used entries are dropped when the cache is full.
+MAX_ENTRIES = 20000
+
+
+def stat_key(path: str) -> str:
+    """
+    Build a cache key for a file from its stat info. If the file is modified or replaced,
+    its key will change.
+
+    :param path: Path to file.
+    :type path: str
+    :return: Cache key, of the form '<st_dev>:<st_ino>:<st_size>:<st_mtime_ns>'
+    :rtype: str
+    """
+    s = os.stat(path)
+    key = f"{s.st_dev}:{s.st_ino}:{s.st_size}:{s.st_mtime_ns}"
+
+    return key
+
+
+def load(cache_path: str) -> dict[str, dict[str, str]]:
+    """
+    Load a checksum cache file. If no path is provided, or the file does not exist or
+    can't be parsed as a checksum cache, an empty cache is returned.
+
+    :param cache_path: Path to checksum cache file.
+    :type cache_path: str
+    :return: Checksums, indexed by stat key, then by hash algorithm.
+    :rtype: dict[str, dict[str, str]]
+    """
+    cache = {}
+    if cache_path is None or not os.path.exists(cache_path):
+        return cache
+
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        _log.error({"event_type": "load_checksum_cache_failed", "checksum_cache_path": cache_path})
+        return {}
+
+    if not isinstance(cache, dict) or not all(isinstance(digests_by_algo, dict) for digests_by_algo in cache.values()):
+        _log.error({"event_type": "load_checksum_cache_failed", "checksum_cache_path": cache_path})
+        return {}
+
+    _evict(cache)
+
+    return cache
+
+
+def save(cache_path: str, cache: dict[str, dict[str, str]]):
+    """
+    Write a checksum cache file. The file is replaced atomically, so a partially-written
+    cache is never left behind. If no path is provided, nothing is written.
+
+    :param cache_path: Path to checksum cache file.
+    :type cache_path: str
+    :param cache: Checksums, indexed by stat key, then by hash algorithm.
+    :type cache: dict[str, dict[str, str]]
+    """
+    if cache_path is None:
+        return
+
+    tmp_cache_path = cache_path + '.tmp'
+    try:
+        with open(tmp_cache_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_cache_path, cache_path)
+    except OSError as e:
+        _log.error({"event_type": "save_checksum_cache_failed", "checksum_cache_path": cache_path})
+
+
+def get(cache: dict[str, dict[str, str]], stat_key: str, algo: str) -> Optional[str]:
+    """
+    Look up a checksum in the cache. The file is marked as the most-recently-used entry.
+
+    :param cache: Checksums, indexed by stat key, then by hash algorithm.
+    :type cache: dict[str, dict[str, str]]
+    :param stat_key: Cache key for the file (see: stat_key)
+    :type stat_key: str
+    :param algo: Name of the hash algorithm
+    :type algo: str
+    :return: Checksum (hex digest), or None if not cached.
+    :rtype: Optional[str]
+    """
+    digests_by_algo = cache.pop(stat_key, None)
+    if digests_by_algo is None:
+        return None
+    cache[stat_key] = digests_by_algo
+
+    return digests_by_algo.get(algo)
+
+
+def put(cache: dict[str, dict[str, str]], stat_key: str, algo: str, digest: str) -> bool:
+    """
+    Store a checksum in the cache. If the cache is full, the least-recently-used
+    entries are dropped.
+
+    :param cache: Checksums, indexed by stat key, then by hash algorithm.
+    :type cache: dict[str, dict[str, str]]
+    :param stat_key: Cache key for the file (see: stat_key)
+    :type stat_key: str
+    :param algo: Name of the hash algorithm
+    :type algo: str
+    :param digest: Checksum (hex digest)
+    :type digest: str
+    :return: True if the cache was changed (and should be saved), False if the checksum was already cached.
+    :rtype: bool
+    """
+    digests_by_algo = cache.pop(stat_key, {})
+    cache_changed = digests_by_algo.get(algo) != digest
+    digests_by_algo[algo] = digest
+    cache[stat_key] = digests_by_algo
+    _evict(cache)
+
+    return cache_changed
+
+
+def _evict(cache: dict[str, dict[str, str]]):
+    """
+    Drop the least-recently-used entries from a cache, until it holds at most MAX_ENTRIES files.
+
+    :param cache: Checksums, indexed by stat key, then by hash algorithm.
+    :type cache: dict[str, dict[str, str]]
+    """
+    while len(cache) > MAX_ENTRIES:
+        del cache[next(iter(cache))]
@@ -16,11 +16,13 @@ def load_config(config_path: str) -> dict[str, object]:
     with open(config_path, 'r') as f:
         config = json.load(f)
 
-    config['excluded_runs'] = []
+    # Only used for membership tests, so stored as a frozenset for O(1) lookups.
+    excluded_runs = set()
     if 'excluded_runs_list' in config and os.path.exists(config['excluded_runs_list']):
         with open(config['excluded_runs_list'], 'r') as f:
             for line in f.readlines():
-                config['excluded_runs'].append(line.strip())
+                excluded_runs.add(line.strip())
+    config['excluded_runs'] = frozenset(excluded_runs)
 
     config['projects'] = []
     if 'projects_definition_file' in config and os.path.exists(config['projects_definition_file']):
@@ -1,84 +1,479 @@
+import collections
+import concurrent.futures
+import concurrent.futures.process
 import csv
-import datetime
-import glob
 import hashlib
+import importlib.util
+import itertools
 import json
 import logging
+import mmap
+import multiprocessing
 import os
 import re
-import shutil
 import subprocess
-import time
-import uuid
 
 from typing import Iterator, Optional
 
+import auto_irida_uploader.checksum_cache as checksum_cache
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_INTEGRITY_HASH_ALGO = 'sha256'
+
+MISEQ_RUN_ID_REGEX = re.compile(r"\d{6}_M\d{5}_\d+_\d{9}-[A-Z0-9]{5}")
+NEXTSEQ_RUN_ID_REGEX = re.compile(r"\d{6}_VH\d{5}_\d+_[A-Z0-9]{9}")
+
+# Number of threads used to list and check run directories during a scan.
+SCAN_MAX_WORKERS = 8
+
+# Whether files can be looked up relative to an open directory (not supported on Windows).
+_dir_fd_supported = os.stat in os.supports_dir_fd and hasattr(os, 'O_DIRECTORY')
+
+# Used when hashing by reading a file into a re-usable buffer, rather than by mmap.
+HASH_READ_BUFFER_SIZE_BYTES = 1024 * 1024
+
+# blake3 only spreads a single update() across threads when it's given a large input.
+BLAKE3_READ_BUFFER_SIZE_BYTES = 16 * 1024 * 1024
+
+# Checksum worker processes are started from a fork server (or spawned, where that isn't
+# available) rather than forked from this process, since uploads run in background threads
+# while files are being hashed, and forking a multi-threaded process can deadlock the child.
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _checksum_mp_context = multiprocessing.get_context('forkserver')
+else:
+    _checksum_mp_context = multiprocessing.get_context('spawn')
+
+# hashlib.file_digest (python 3.11+) hashes a file object without a python-level read loop.
+_hashlib_file_digest = getattr(hashlib, 'file_digest', None)
+
+PYARROW_SAMPLELIST_MIN_SIZE_BYTES = 1024 * 1024
+
+# pyarrow is optional, and is only imported when it is needed.
+_pyarrow_available = importlib.util.find_spec('pyarrow') is not None
+
+# Parsed SampleList.csv and upload_prepared.json files (and SampleList.csv header
+# validation results), indexed by path.
+# Only re-parsed when the file's size or modification time changes (see: _load_if_changed).
+# Each cache holds at most LOADED_FILE_CACHE_MAX_ENTRIES files, and the least-recently-used
+# files are dropped when it is full.
+LOADED_FILE_CACHE_MAX_ENTRIES = 256
+_parsed_samplelists_by_path = {}
+_upload_preparation_data_by_path = {}
+_samplelist_header_is_valid_by_path = {}
+
+# Number of lines of irida-uploader output to include in the log when an upload fails.
+IRIDA_UPLOADER_OUTPUT_TAIL_LINES = 20
+
+# Used to discard irida-uploader output that can't be read as text.
+IRIDA_UPLOADER_OUTPUT_READ_SIZE_BYTES = 64 * 1024
+
+# Enough to hold the '[Data]' header line of a SampleList.csv file, with some room for quotes and whitespace.
+SAMPLELIST_HEADER_READ_SIZE_BYTES = 64
+
+# Checksum caches are loaded once per process, then kept up-to-date in memory.
+# Indexed by 'checksum_cache_path' from the config. If no path is configured,
+# the cache is held in memory only (under the key None).
+_checksum_caches_by_path = {}
+
+
+def _parse_samplelist_pyarrow(samplelist_path):
+    """
+    Parse a SampleList.csv file using pyarrow's multi-threaded C++ csv reader.
+    Only called when pyarrow is installed.
+
+    :param samplelist_path: Path to SampleList.csv file
+    :type samplelist_path: str
+    :return: SampleList data, indexed by library ID.
+    :rtype: dict[dict[str, str]]
+    :raises pyarrow.ArrowInvalid: If the file can't be parsed (eg. rows with missing fields)
+    """
+    import pyarrow
+    import pyarrow.csv
+
+    columns = ['Sample_Name', 'Project_ID', 'File_Forward', 'File_Reverse']
+    table = pyarrow.csv.read_csv(
+        samplelist_path,
+        read_options=pyarrow.csv.ReadOptions(skip_rows=1), # skip [Data] header line
+        convert_options=pyarrow.csv.ConvertOptions(
+            include_columns=columns,
+            column_types={column: pyarrow.string() for column in columns},
+            strings_can_be_null=False,
+        ),
+    )
+
+    samplelist_data_by_library_id = {}
+    rows = zip(*[table[column].to_pylist() for column in columns])
+    for library_id, project_id, fastq_forward_filename, fastq_reverse_filename in rows:
+        samplelist_data_by_library_id[library_id] = {
+            'library_id': library_id,
+            'project_id': project_id,
+            'fastq_forward_filename': fastq_forward_filename,
+            'fastq_reverse_filename': fastq_reverse_filename,
+        }
+
+    return samplelist_data_by_library_id
+
 
 def parse_samplelist(samplelist_path):
     """
     Parse a SampleList.csv file, and return a dict of dicts. Outer dict keys are library IDs.
     Inner dicts include keys: 'library_id', 'project_id', 'fastq_forward_filename', 'fastq_reverse_filename'
 
+    Large files are parsed with pyarrow, if it is installed. Importing pyarrow costs more
+    than parsing a typical SampleList.csv with the csv module, so it is only used for files
+    of at least PYARROW_SAMPLELIST_MIN_SIZE_BYTES.
+
     :param samplelist_path: Path to SampleList.csv file
     :type samplelist_path: str
     :return: SampleList data, indexed by library ID.
     :rtype: dict[dict[str, str]]
     """
+    if _pyarrow_available and os.path.getsize(samplelist_path) >= PYARROW_SAMPLELIST_MIN_SIZE_BYTES:
+        try:
+            return _parse_samplelist_pyarrow(samplelist_path)
+        except ValueError as e:
+            # pyarrow.ArrowInvalid is a ValueError. The csv module is more
+            # lenient (eg. short rows), so fall back to it.
+            pass
+
     samplelist_data_by_library_id = {}
     with open(samplelist_path, 'r') as f:
         next(f) # skip [Data] header line
-        reader = csv.DictReader(f, dialect='unix')
+        reader = csv.reader(f, dialect='unix')
+        header = next(reader, None)
+        if header is None:
+            return samplelist_data_by_library_id
+        column_index_by_name = {name: i for i, name in enumerate(header)}
+        sample_name_index = column_index_by_name['Sample_Name']
+        project_id_index = column_index_by_name['Project_ID']
+        file_forward_index = column_index_by_name['File_Forward']
+        file_reverse_index = column_index_by_name['File_Reverse']
         for row in reader:
-            library_id = row['Sample_Name']
-            library = {
+            if not row:
+                continue
+            if len(row) < len(header):
+                row += [None] * (len(header) - len(row))
+            library_id = row[sample_name_index]
+            samplelist_data_by_library_id[library_id] = {
                 'library_id': library_id,
-                'project_id': row['Project_ID'],
-                'fastq_forward_filename': row['File_Forward'],
-                'fastq_reverse_filename': row['File_Reverse'],
+                'project_id': row[project_id_index],
+                'fastq_forward_filename': row[file_forward_index],
+                'fastq_reverse_filename': row[file_reverse_index],
             }
-            samplelist_data_by_library_id[library_id] = library
 
     return samplelist_data_by_library_id
 
 
-def collect_md5_checksums(run_dir, samplelist_data_by_library_id):
+def _advise_sequential_read(fd):
+    """
+    Tell the kernel that a file will be read from start to end, so that it widens
+    read-ahead. The file isn't read into the page cache ahead of time (WILLNEED), since
+    several multi-GB files are hashed at once, and that could evict pages that are
+    still needed. Does nothing on platforms without posix_fadvise.
+
+    :param fd: File descriptor
+    :type fd: int
     """
-    Collect md5 checksums for all fastq files in run_dir.
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError as e:
+        # Advice is only a hint. Some filesystems reject it.
+        pass
+
+
+def _update_hash_from_file(file_hash, f, buffer_size):
+    """
+    Feed the remaining contents of a file to a hash object, reading it into a single
+    re-usable buffer.
+
+    :param file_hash: Hash object (from hashlib or blake3)
+    :type file_hash: object
+    :param f: File, opened in binary mode
+    :type f: io.BufferedReader
+    :param buffer_size: Size of the read buffer, in bytes
+    :type buffer_size: int
+    """
+    buffer = bytearray(buffer_size)
+    buffer_view = memoryview(buffer)
+    while num_bytes_read := f.readinto(buffer):
+        file_hash.update(buffer_view[:num_bytes_read])
+
+
+def _checksum_file(path, algo):
+    """
+    Compute the checksum of a single file. The file is memory-mapped so that its pages
+    are handed straight to the hash function without being copied into python objects.
+    Defined at module level so that it can be dispatched to worker processes.
+
+    :param path: Path to file
+    :type path: str
+    :param algo: Name of the hash algorithm to use (eg. 'sha256', 'md5', 'blake3')
+    :type algo: str
+    :return: Checksum (hex digest), or None if the file could not be read.
+    :rtype: Optional[str]
+    """
+    try:
+        if algo == 'blake3':
+            # blake3 files are hashed in the daemon process itself, so they're read rather
+            # than memory-mapped. If a mapped file is truncated while it's being hashed, the
+            # process is killed by SIGBUS.
+            file_hash = blake3.blake3(max_threads=blake3.blake3.AUTO)
+            with open(path, 'rb') as f:
+                _advise_sequential_read(f.fileno())
+                _update_hash_from_file(file_hash, f, BLAKE3_READ_BUFFER_SIZE_BYTES)
+            return file_hash.hexdigest()
+        with open(path, 'rb') as f:
+            _advise_sequential_read(f.fileno())
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    return hashlib.new(algo, mm).hexdigest()
+            except (ValueError, OSError) as e:
+                # Empty files can't be memory-mapped, and some filesystems don't support
+                # mmap. Fall through to reading the file.
+                pass
+            if _hashlib_file_digest is not None:
+                return _hashlib_file_digest(f, algo).hexdigest()
+            file_hash = hashlib.new(algo)
+            _update_hash_from_file(file_hash, f, HASH_READ_BUFFER_SIZE_BYTES)
+            return file_hash.hexdigest()
+    except OSError as e:
+        return None
+
+
+def _checksum_files(fastqs, algo):
+    """
+    Compute checksums for a list of fastq files. blake3 already hashes a single file
+    using all available cores, so blake3 checksums are computed one file at a time in
+    this process. For other algorithms, each file is submitted as a separate task to
+    a pool with one worker process per CPU. If a worker process dies, the files that
+    it hadn't finished hashing get a checksum of None.
+
+    :param fastqs: Fastq files to checksum, as tuples of: (library ID, direction, path, stat key)
+    :type fastqs: list[tuple[str, str, str, str]]
+    :param algo: Name of the hash algorithm to use (eg. 'sha256', 'md5', 'blake3')
+    :type algo: str
+    :return: Fastq files with their checksums (or None if the file could not be read), as they're completed.
+    :rtype: Iterator[tuple[tuple[str, str, str, str], Optional[str]]]
+    """
+    if algo == 'blake3':
+        for fastq in fastqs:
+            yield fastq, _checksum_file(fastq[2], algo)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_checksum_mp_context) as executor:
+        fastqs_by_future = {executor.submit(_checksum_file, fastq[2], algo): fastq for fastq in fastqs}
+        for future in concurrent.futures.as_completed(fastqs_by_future):
+            fastq = fastqs_by_future[future]
+            try:
+                digest = future.result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # A worker was killed, eg. by SIGBUS when a memory-mapped file was truncated
+                # while it was being hashed. The pool can't be used after that, so every file
+                # that hadn't been hashed yet is treated as unreadable.
+                _log.error({"event_type": "checksum_failed", "fastq_path": fastq[2], "algo": algo})
+                digest = None
+            yield fastq, digest
+
+
+def collect_checksums(run_dir, samplelist_data_by_library_id, algo=DEFAULT_INTEGRITY_HASH_ALGO, cache=None):
+    """
+    Collect checksums for all fastq files in run_dir (see: _checksum_files). If a checksum
+    cache is provided, files whose stat info hasn't changed since they were last hashed
+    are not re-hashed, and newly-computed checksums are added to the cache.
 
     :param run_dir: Path to run dir to be uploaded
     :type run_dir: str
     :param samplelist_data: Parsed SampleList.csv file
-    :type samplelist_data:
-    :return:
-    :rtype:
+    :type samplelist_data: dict[str, dict[str, str]]
+    :param algo: Name of the hash algorithm to use (eg. 'sha256', 'md5', 'blake3')
+    :type algo: str
+    :param cache: Checksum cache (see: auto_irida_uploader.checksum_cache)
+    :type cache: Optional[dict[str, dict[str, str]]]
+    :return: Checksums, indexed by library ID (inner dicts include keys: 'library_id', 'algo', 'fastq_forward_digest', 'fastq_reverse_digest'), and whether the cache was changed.
+    :rtype: tuple[dict[str, dict[str, str]], bool]
     """
-    md5_checksums_by_library_id = {}
+    cache_changed = False
+    checksums_by_library_id = {}
+    fastqs_to_checksum = []
     for library_id, samplelist_data in samplelist_data_by_library_id.items():
-        fastq_forward_path = os.path.join(run_dir, samplelist_data['fastq_forward_filename'])
-        fastq_forward_realpath = os.path.realpath(fastq_forward_path)
-        fastq_forward_md5 = None
-        with open(fastq_forward_realpath, 'rb') as f:
-            fastq_forward_hash = hashlib.md5()
-            while chunk := f.read(8192):
-                fastq_forward_hash.update(chunk)
-            fastq_forward_md5 = fastq_forward_hash.hexdigest()
-        fastq_reverse_path = os.path.join(run_dir, samplelist_data['fastq_reverse_filename'])
-        fastq_reverse_realpath = os.path.realpath(fastq_reverse_path)
-        fastq_reverse_md5 = None
-        with open(fastq_reverse_realpath, 'rb') as f:
-            fastq_reverse_hash = hashlib.md5()
-            while chunk := f.read(8192):
-                fastq_reverse_hash.update(chunk)
-            fastq_reverse_md5 = fastq_reverse_hash.hexdigest()
-
-        md5_checksums_by_library_id[library_id] = {
+        checksums_by_library_id[library_id] = {
             'library_id': library_id,
-            'fastq_forward_md5': fastq_forward_md5,
-            'fastq_reverse_md5': fastq_reverse_md5,
+            'algo': algo,
+            'fastq_forward_digest': None,
+            'fastq_reverse_digest': None,
         }
+        for direction in ['forward', 'reverse']:
+            fastq_path = os.path.join(run_dir, samplelist_data['fastq_' + direction + '_filename'])
+            try:
+                fastq_stat_key = checksum_cache.stat_key(fastq_path)
+            except OSError as e:
+                continue
+            cached_digest = None
+            if cache is not None:
+                cached_digest = checksum_cache.get(cache, fastq_stat_key, algo)
+            if cached_digest is not None:
+                checksums_by_library_id[library_id]['fastq_' + direction + '_digest'] = cached_digest
+            else:
+                fastqs_to_checksum.append((library_id, direction, fastq_path, fastq_stat_key))
+
+    if not fastqs_to_checksum:
+        return checksums_by_library_id, cache_changed
+
+    for (library_id, direction, fastq_path, fastq_stat_key), digest in _checksum_files(fastqs_to_checksum, algo):
+        checksums_by_library_id[library_id]['fastq_' + direction + '_digest'] = digest
+        if cache is not None and digest is not None:
+            if checksum_cache.put(cache, fastq_stat_key, algo, digest):
+                cache_changed = True
+
+    return checksums_by_library_id, cache_changed
+
+
+def check_fastq_sizes(run_dir, samplelist_data_by_library_id, upload_preparation_data):
+    """
+    Compare the sizes of the fastq files in run_dir against the sizes recorded in
+    upload_prepared.json. This only requires a stat call per file, so it's used to
+    reject incomplete or truncated runs before any files are hashed. Libraries that
+    don't have 'fastq_forward_size' and 'fastq_reverse_size' fields aren't checked.
+
+    :param run_dir: Path to run dir to be uploaded
+    :type run_dir: str
+    :param samplelist_data_by_library_id: Parsed SampleList.csv file
+    :type samplelist_data_by_library_id: dict[str, dict[str, str]]
+    :param upload_preparation_data: Parsed upload_prepared.json file
+    :type upload_preparation_data: dict
+    :return: True if all recorded sizes match, False otherwise.
+    :rtype: bool
+    """
+    for library in upload_preparation_data.get('libraries', []):
+        library_id = library['library_id']
+        if library_id not in samplelist_data_by_library_id:
+            continue
+        for direction in ['forward', 'reverse']:
+            expected_size = library.get('fastq_' + direction + '_size')
+            if expected_size is None:
+                continue
+            fastq_path = os.path.join(run_dir, samplelist_data_by_library_id[library_id]['fastq_' + direction + '_filename'])
+            try:
+                size = os.stat(fastq_path).st_size
+            except OSError as e:
+                size = None
+            if size != expected_size:
+                _log.info({
+                    "event_type": "fastq_size_mismatch",
+                    "library_id": library_id,
+                    "fastq_path": fastq_path,
+                    "expected_size": expected_size,
+                    "size": size,
+                })
+                return False
+
+    return True
+
+
+def integrity_hash_algo_is_supported(algo):
+    """
+    Check whether checksums can be computed with an algorithm. 'blake3' is supported
+    when the optional blake3 package is installed, all others must be provided by hashlib.
+    The algorithm name comes from upload_prepared.json, so anything other than the name of
+    a fixed-length hash (eg. a non-string value, or 'shake_256') is not supported.
+
+    :param algo: Name of the hash algorithm
+    :type algo: object
+    :return: True if the algorithm is supported, False otherwise.
+    :rtype: bool
+    """
+    if not isinstance(algo, str):
+        return False
+
+    if algo == 'blake3':
+        return blake3 is not None
+
+    if algo not in hashlib.algorithms_available:
+        return False
+
+    # Variable-length hashes (shake_128, shake_256) report a digest_size of 0,
+    # and need a length to be passed to hexdigest().
+    try:
+        return hashlib.new(algo).digest_size > 0
+    except ValueError as e:
+        return False
+
+
+def get_integrity_hash_algo(config, upload_preparation_data):
+    """
+    Determine which hash algorithm was used to produce the checksums in an upload_prepared.json file.
+    Older files only include 'fastq_forward_md5' and 'fastq_reverse_md5' fields, so those are
+    always checked with md5. Newer files include 'fastq_forward_digest' and 'fastq_reverse_digest'
+    fields, along with an 'algo' field. If the 'algo' field is missing, the 'integrity_hash_algo'
+    from the config is used.
+
+    :param config: Application config
+    :type config: dict
+    :param upload_preparation_data: Parsed upload_prepared.json file
+    :type upload_preparation_data: dict
+    :return: Name of the hashlib algorithm
+    :rtype: str
+    """
+    libraries = upload_preparation_data.get('libraries', [])
+    if any('fastq_forward_md5' in library for library in libraries):
+        return 'md5'
 
-    return md5_checksums_by_library_id
-    
+    return upload_preparation_data.get('algo', config.get('integrity_hash_algo', DEFAULT_INTEGRITY_HASH_ALGO))
+
+
+def _load_json(path):
+    """
+    Load a json file.
+
+    :param path: Path to json file
+    :type path: str
+    :return: Parsed json
+    :rtype: object
+    """
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _load_if_changed(cache, path, load):
+    """
+    Load a file, re-using the previously-loaded data if the file's size and
+    modification time haven't changed since it was last loaded. Data returned
+    from the cache is shared between callers, and should not be modified.
+    The cache is kept in least-recently-used order, and holds at most
+    LOADED_FILE_CACHE_MAX_ENTRIES files.
+
+    :param cache: Previously-loaded data, indexed by path. Updated in-place.
+    :type cache: dict[str, tuple[tuple[int, int], object]]
+    :param path: Path to file
+    :type path: str
+    :param load: Function that takes a path and returns the loaded data
+    :type load: Callable[[str], object]
+    :return: Loaded data
+    :rtype: object
+    """
+    s = os.stat(path)
+    file_stat = (s.st_size, s.st_mtime_ns)
+    cached = cache.pop(path, None)
+    if cached is not None and cached[0] == file_stat:
+        cache[path] = cached
+        return cached[1]
+
+    data = load(path)
+    cache[path] = (file_stat, data)
+    while len(cache) > LOADED_FILE_CACHE_MAX_ENTRIES:
+        del cache[next(iter(cache))]
+
+    return data
 
 
 def check_ready_to_upload(config, run_dir):
@@ -90,109 +485,269 @@ def check_ready_to_upload(config, run_dir):
     :param run_dir: Path to run directory to be uploaded
     :type run_dir: str
     """
-    upload_prepared_path = os.path.join(run_dir, 'upload_prepared.json')
-    samplelist_path = os.path.join(run_dir, 'SampleList.csv')
-    if not os.path.exists(upload_prepared_path):
+    # The run dir may have been moved or removed since it was found.
+    try:
+        with os.scandir(run_dir) as run_dir_entries:
+            run_dir_filenames = {entry.name for entry in run_dir_entries}
+    except (FileNotFoundError, NotADirectoryError) as e:
         return False
-    if not os.path.exists(samplelist_path):
+    if 'upload_prepared.json' not in run_dir_filenames:
         return False
+    if 'SampleList.csv' not in run_dir_filenames:
+        return False
+
+    upload_prepared_path = os.path.join(run_dir, 'upload_prepared.json')
+    samplelist_path = os.path.join(run_dir, 'SampleList.csv')
 
-    samplelist_data_by_library_id = parse_samplelist(samplelist_path)
     upload_preparation_data = {}
     try:
-        with open(upload_prepared_path, 'r') as f:
-            upload_preparation_data = json.load(f)
-        # print(json.dumps(upload_preparation_data, indent=2))
-        # exit()
+        samplelist_data_by_library_id = _load_if_changed(_parsed_samplelists_by_path, samplelist_path, parse_samplelist)
+        upload_preparation_data = _load_if_changed(_upload_preparation_data_by_path, upload_prepared_path, _load_json)
+    except (FileNotFoundError, NotADirectoryError) as e:
+        return False
     except json.JSONDecodeError as e:
-        logging.error(json.dumps({
+        _log.error({
             "event_type": "parse_upload_prepared_failed",
             "upload_prepared_file_path": upload_prepared_path,
-        }))
+        })
         return False
 
-    md5_checksums_by_library_id = collect_md5_checksums(run_dir, samplelist_data_by_library_id)
+    algo = get_integrity_hash_algo(config, upload_preparation_data)
+    if not integrity_hash_algo_is_supported(algo):
+        _log.error({
+            "event_type": "unsupported_integrity_hash_algo",
+            "upload_prepared_file_path": upload_prepared_path,
+            "algo": algo,
+        })
+        return False
 
-    md5_checksums_match_by_library_id = {}
+    if not check_fastq_sizes(run_dir, samplelist_data_by_library_id, upload_preparation_data):
+        return False
+
+    checksum_cache_path = config.get('checksum_cache_path')
+    if checksum_cache_path not in _checksum_caches_by_path:
+        _checksum_caches_by_path[checksum_cache_path] = checksum_cache.load(checksum_cache_path)
+    cache = _checksum_caches_by_path[checksum_cache_path]
+    checksums_by_library_id, cache_changed = collect_checksums(run_dir, samplelist_data_by_library_id, algo, cache)
+    # A fully-cached run doesn't change the cache, so the cache file is only re-written
+    # when new checksums have been computed.
+    if cache_changed:
+        checksum_cache.save(checksum_cache_path, cache)
+
+    checksums_match_by_library_id = {}
     for library in upload_preparation_data.get('libraries', []):
         library_id = library['library_id']
-        expected_fastq_forward_md5 = library['fastq_forward_md5']
-        expected_fastq_reverse_md5 = library['fastq_reverse_md5']
-        collected_fastq_forward_md5 = md5_checksums_by_library_id[library_id]['fastq_forward_md5']
-        collected_fastq_reverse_md5 = md5_checksums_by_library_id[library_id]['fastq_reverse_md5']
-        checksums_match = (collected_fastq_forward_md5 == expected_fastq_forward_md5) and (collected_fastq_reverse_md5 == expected_fastq_reverse_md5)
-        md5_checksums_match_by_library_id[library_id] = checksums_match
-
-    if all(md5_checksums_match_by_library_id.values()):
+        expected_fastq_forward_digest = library.get('fastq_forward_digest', library.get('fastq_forward_md5'))
+        expected_fastq_reverse_digest = library.get('fastq_reverse_digest', library.get('fastq_reverse_md5'))
+        collected_fastq_forward_digest = checksums_by_library_id[library_id]['fastq_forward_digest']
+        collected_fastq_reverse_digest = checksums_by_library_id[library_id]['fastq_reverse_digest']
+        checksums_match = (collected_fastq_forward_digest == expected_fastq_forward_digest) and (collected_fastq_reverse_digest == expected_fastq_reverse_digest)
+        checksums_match_by_library_id[library_id] = checksums_match
+
+    if all(checksums_match_by_library_id.values()):
         return True
     else:
         return False
 
 
+def get_instrument_type(run_id):
+    """
+    Determine the type of instrument that a run was sequenced on, from its run ID.
+
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: Instrument type. One of: 'miseq', 'nextseq', 'unknown'
+    :rtype: str
+    """
+    instrument_type = 'unknown'
+    if MISEQ_RUN_ID_REGEX.match(run_id):
+        instrument_type = 'miseq'
+    elif NEXTSEQ_RUN_ID_REGEX.match(run_id):
+        instrument_type = 'nextseq'
+
+    return instrument_type
+
+
+def _exists_at(dir_fd, path):
+    """
+    Check whether a path exists. If a directory file descriptor is provided, a relative
+    path is resolved from that directory, rather than from the root.
+
+    :param dir_fd: Open directory file descriptor, or None
+    :type dir_fd: Optional[int]
+    :param path: Path to check. Relative to dir_fd, if provided.
+    :type path: str
+    :return: True if the path exists, False otherwise.
+    :rtype: bool
+    """
+    try:
+        os.stat(path, dir_fd=dir_fd)
+    except (OSError, ValueError) as e:
+        return False
+
+    return True
+
+
+def _check_run_dir(config, subdir, parent_dir_fd=None):
+    """
+    Check whether a directory is a sequencing run that might need to be uploaded, using
+    only its name and directory metadata. Checks are made in order of increasing cost,
+    and stop at the first one that fails. The (much more expensive) check that a run's
+    files are ready to upload is left to the caller.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param subdir: Directory entry to check
+    :type subdir: os.DirEntry
+    :param parent_dir_fd: Open file descriptor for subdir's parent directory. If provided, files in subdir are looked up relative to it.
+    :type parent_dir_fd: Optional[int]
+    :return: Results of the conditions that were checked, indexed by condition name.
+    :rtype: dict[str, bool]
+    """
+    conditions_checked = {}
+
+    conditions_checked["is_directory"] = subdir.is_dir()
+    if not conditions_checked["is_directory"]:
+        return conditions_checked
+
+    conditions_checked["matches_illumina_run_id_format"] = get_instrument_type(subdir.name) != 'unknown'
+    if not conditions_checked["matches_illumina_run_id_format"]:
+        return conditions_checked
+
+    not_excluded = True
+    if 'excluded_runs' in config:
+        not_excluded = not subdir.name in config['excluded_runs']
+    conditions_checked["not_excluded"] = not_excluded
+    if not conditions_checked["not_excluded"]:
+        return conditions_checked
+
+    if parent_dir_fd is None:
+        irida_uploader_status_path = os.path.join(subdir.path, 'irida_upload_completed.json')
+    else:
+        irida_uploader_status_path = os.path.join(subdir.name, 'irida_upload_completed.json')
+    conditions_checked["not_already_uploaded"] = not _exists_at(parent_dir_fd, irida_uploader_status_path)
+
+    return conditions_checked
+
+
+def _inode(entry):
+    """
+    Sort key for directory entries. Visiting entries in inode order (rather than directory
+    order) means that subsequent lookups read the filesystem's inode table roughly
+    sequentially, rather than seeking around it.
+
+    :param entry: Directory entry
+    :type entry: os.DirEntry
+    :return: Inode number of the entry
+    :rtype: int
+    """
+    return entry.inode()
+
+
+def _scan_timestamped_subdir(config, timestamped_subdir):
+    """
+    List the run directories in one timestamped subdirectory of the 'runs_to_upload_dir',
+    and check each one with _check_run_dir.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param timestamped_subdir: Timestamped subdirectory to scan
+    :type timestamped_subdir: os.DirEntry
+    :return: Scanned run directories, as tuples of: (directory entry, absolute path, conditions checked)
+    :rtype: list[tuple[os.DirEntry, str, dict[str, bool]]]
+    """
+    scanned_run_dirs = []
+    with os.scandir(timestamped_subdir) as timestamped_subdir_entries:
+        run_subdirs = sorted(timestamped_subdir_entries, key=_inode)
+    # Entry names never contain a separator, and scandir doesn't return '.' or '..',
+    # so joining them onto the (already normalized) parent path is equivalent to abspath.
+    timestamped_subdir_path = os.path.abspath(timestamped_subdir.path)
+
+    # Where supported, look up files in each run dir relative to an open handle on this
+    # directory, so the kernel doesn't re-resolve the whole path for each lookup.
+    timestamped_subdir_fd = None
+    if _dir_fd_supported:
+        timestamped_subdir_fd = os.open(timestamped_subdir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for subdir in run_subdirs:
+            run_dir_path = f"{timestamped_subdir_path}{os.sep}{subdir.name}"
+            conditions_checked = _check_run_dir(config, subdir, timestamped_subdir_fd)
+            scanned_run_dirs.append((subdir, run_dir_path, conditions_checked))
+    finally:
+        if timestamped_subdir_fd is not None:
+            os.close(timestamped_subdir_fd)
+
+    return scanned_run_dirs
+
+
 def find_run_dirs(config):
     """
     Find sequencing run directories under the 'run_parent_dirs' listed in the config.
 
+    The timestamped subdirectories of each 'runs_to_upload_dir' are listed and checked
+    concurrently, in a pool of SCAN_MAX_WORKERS threads. Run directories that pass those
+    checks are then checked for readiness to upload (which involves hashing their files)
+    one at a time, as they're yielded.
+
     :param config: Application config.
     :type config: dict[str, object]
-    :param check_upload_complete: Check for presence of 'upload_complete.json' file.
-    :type check_upload_complete: bool
     :return: Run directory. Keys: ['sequencing_run_id', 'path', 'instrument_type']
     :rtype: Iterator[Optional[dict[str, str]]]
     """
-    miseq_run_id_regex = "\d{6}_M\d{5}_\d+_\d{9}-[A-Z0-9]{5}"
-    nextseq_run_id_regex = "\d{6}_VH\d{5}_\d+_[A-Z0-9]{9}"
     runs_to_upload_dirs = [config['runs_to_upload_dir']]
 
     for runs_to_upload_dir in runs_to_upload_dirs:
-        timestamped_subdirs = list(os.scandir(runs_to_upload_dir))
+        with os.scandir(runs_to_upload_dir) as runs_to_upload_dir_entries:
+            timestamped_subdirs = sorted((entry for entry in runs_to_upload_dir_entries if entry.is_dir()), key=_inode)
+
+        scanned_run_dirs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_MAX_WORKERS) as executor:
+            for scanned_timestamped_subdir in executor.map(_scan_timestamped_subdir, itertools.repeat(config), timestamped_subdirs):
+                scanned_run_dirs.extend(scanned_timestamped_subdir)
+
+        for subdir, run_dir_path, conditions_checked in scanned_run_dirs:
+            # Most entries are rejected here (already uploaded, not a run, etc.) on every scan,
+            # so they're only logged at debug level.
+            if not all(conditions_checked.values()):
+                if _log.isEnabledFor(logging.DEBUG):
+                    _log.debug({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "conditions_checked": conditions_checked})
+                yield None
+                continue
 
-        for timestamped_subdir in timestamped_subdirs:
-            if not os.path.isdir(timestamped_subdir):
+            conditions_checked["ready_to_upload"] = check_ready_to_upload(config, run_dir_path)
+            if not conditions_checked["ready_to_upload"]:
+                _log.info({"event_type": "directory_skipped", "run_directory_path": run_dir_path, "conditions_checked": conditions_checked})
+                yield None
                 continue
-            run_subdirs = list(os.scandir(timestamped_subdir))
-            for subdir in run_subdirs:
-                run_id = subdir.name
-                matches_miseq_regex = re.match(miseq_run_id_regex, run_id)
-                matches_nextseq_regex = re.match(nextseq_run_id_regex, run_id)
-                instrument_type = 'unknown'
-                if matches_miseq_regex:
-                    instrument_type = 'miseq'
-                elif matches_nextseq_regex:
-                    instrument_type = 'nextseq'
-
-                not_already_uploaded = True
-                irida_uploader_status_path = os.path.join(subdir.path, 'irida_upload_completed.json')
-                if os.path.exists(irida_uploader_status_path):
-                    not_already_uploaded = False
-            
-                not_excluded = True
-                if 'excluded_runs' in config:
-                    not_excluded = not run_id in config['excluded_runs']
-
-                conditions_checked = {
-                    "is_directory": subdir.is_dir(),
-                    "matches_illumina_run_id_format": ((matches_miseq_regex is not None) or
-                                                       (matches_nextseq_regex is not None)),
-                    "not_already_uploaded": not_already_uploaded,
-                    "not_excluded": not_excluded,
-                }
-
-                if all(conditions_checked.values()):
-                    ready_to_upload = check_ready_to_upload(config, os.path.abspath(subdir))
-                    conditions_checked["ready_to_upload"] = ready_to_upload
-
-                conditions_met = list(conditions_checked.values())
-                run = {}
-                if all(conditions_met):
-                    logging.info(json.dumps({"event_type": "run_directory_found", "sequencing_run_id": run_id, "run_directory_path": os.path.abspath(subdir.path), "conditions_checked": conditions_checked}))
-                    run['path'] = os.path.abspath(subdir.path)
-                    run['sequencing_run_id'] = run_id
-                    run['instrument_type'] = instrument_type
-                    yield run
-                else:
-                    logging.info(json.dumps({"event_type": "directory_skipped", "run_directory_path": os.path.abspath(subdir.path), "conditions_checked": conditions_checked}))
-                    yield None
+
+            run_id = subdir.name
+            _log.info({"event_type": "run_directory_found", "sequencing_run_id": run_id, "run_directory_path": run_dir_path, "conditions_checked": conditions_checked})
+            run = {
+                'path': run_dir_path,
+                'sequencing_run_id': run_id,
+                'instrument_type': get_instrument_type(run_id),
+            }
+            yield run
+
+
+def _samplelist_header_is_valid(samplelist_path):
+    """
+    Check that the first line of a SampleList.csv file is '[Data]' (ignoring quotes).
+
+    :param samplelist_path: Path to SampleList.csv file
+    :type samplelist_path: str
+    :return: True if the header is valid, False otherwise.
+    :rtype: bool
+    """
+    with open(samplelist_path, 'rb') as samplelist_file:
+        head = samplelist_file.read(SAMPLELIST_HEADER_READ_SIZE_BYTES)
+    # splitlines() recognizes the same line endings as reading in text mode ('\n', '\r\n' and '\r').
+    head_lines = head.splitlines()
+    if not head_lines:
+        return False
+    header_line = head_lines[0]
+
+    return header_line.strip().translate(None, b'"\'') == b'[Data]'
 
 
 def validate_samplelist(config, run):
@@ -208,17 +763,14 @@ def validate_samplelist(config, run):
     """
     samplelist_path = os.path.join(run['path'], 'SampleList.csv')
     samplelist_is_valid = False
-    if os.path.exists(samplelist_path):
-        with open(samplelist_path, 'r') as samplelist_file:
-            header_line = samplelist_file.readline()
-            header_line = header_line.strip()
-            header_line = header_line.replace('"', '')
-            header_line = header_line.replace("'", '')
-            if header_line == '[Data]':
-                samplelist_is_valid = True
-                logging.info(json.dumps({"event_type": "samplelist_valid", "sequencing_run_id": run['sequencing_run_id'], "samplelist_path": samplelist_path}))
-    else:
-        logging.error(json.dumps({"event_type": "samplelist_missing", "sequencing_run_id": run['sequencing_run_id'], "samplelist_path": samplelist_path}))
+    try:
+        samplelist_is_valid = _load_if_changed(_samplelist_header_is_valid_by_path, samplelist_path, _samplelist_header_is_valid)
+    except FileNotFoundError as e:
+        _log.error({"event_type": "samplelist_missing", "sequencing_run_id": run['sequencing_run_id'], "samplelist_path": samplelist_path})
+        return samplelist_is_valid
+
+    if samplelist_is_valid:
+        _log.info({"event_type": "samplelist_valid", "sequencing_run_id": run['sequencing_run_id'], "samplelist_path": samplelist_path})
 
     return samplelist_is_valid
             
@@ -234,7 +786,7 @@ def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, object]]]:
     :return: A run directory to analyze, or None
     :rtype: Iterator[Optional[dict[str, object]]]
     """
-    logging.info(json.dumps({"event_type": "scan_start"}))
+    _log.info({"event_type": "scan_start"})
     for run_dir in find_run_dirs(config):    
         yield run_dir
         
@@ -258,14 +810,48 @@ def upload_run(config, run):
         '--config_parser', config['parser'],
         '--directory', upload_dir,
     ]
-
-    logging.info(json.dumps({"event_type": "upload_started", "sequencing_run_id": run_id, "irida_uploader_command": " ".join(irida_uploader_command)}))
+    # The password and client secret are redacted from the command that we log.
+    redacted_args = ['--config_password', '--config_client_secret']
+    irida_uploader_command_str = " ".join(
+        '***' if previous_arg in redacted_args else arg
+        for previous_arg, arg in zip([''] + irida_uploader_command, irida_uploader_command)
+    )
+
+    _log.info({"event_type": "upload_started", "sequencing_run_id": run_id, "irida_uploader_command": irida_uploader_command_str})
+    # irida-uploader's console output is passed through our logger at debug level, rather
+    # than being written directly to our stdout. The last few lines are kept, so they can
+    # be included in the log if the upload fails.
+    irida_uploader_output_tail = collections.deque(maxlen=IRIDA_UPLOADER_OUTPUT_TAIL_LINES)
     try:
-        upload_result = subprocess.run(irida_uploader_command, capture_output=False, check=True, text=True)
+        with subprocess.Popen(irida_uploader_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace', bufsize=1) as upload_process:
+            try:
+                for line in upload_process.stdout:
+                    line = line.rstrip('\n')
+                    irida_uploader_output_tail.append(line)
+                    if _log.isEnabledFor(logging.DEBUG):
+                        _log.debug({"event_type": "irida_uploader_output", "sequencing_run_id": run_id, "output": line})
+            except (OSError, ValueError) as e:
+                # Whether the upload succeeded is decided by irida-uploader's exit status alone,
+                # so failing to read its output doesn't fail the upload. The rest of its output
+                # is discarded until it exits, rather than closing the pipe while it's still
+                # running, which would kill it with SIGPIPE on its next write.
+                _log.warning({"event_type": "irida_uploader_output_read_failed", "sequencing_run_id": run_id, "error": str(e)})
+                try:
+                    while upload_process.stdout.buffer.read(IRIDA_UPLOADER_OUTPUT_READ_SIZE_BYTES):
+                        pass
+                except (OSError, ValueError) as e:
+                    _log.warning({"event_type": "irida_uploader_output_read_failed", "sequencing_run_id": run_id, "error": str(e)})
+        if upload_process.returncode != 0:
+            raise subprocess.CalledProcessError(upload_process.returncode, irida_uploader_command_str)
         upload_successful = True
-        logging.info(json.dumps({"event_type": "upload_completed", "sequencing_run_id": run_id, "irida_uploader_command": " ".join(irida_uploader_command)}))
+        _log.info({"event_type": "upload_completed", "sequencing_run_id": run_id, "irida_uploader_command": irida_uploader_command_str})
     except subprocess.CalledProcessError as e:
-        logging.error(json.dumps({"event_type": "upload_failed", "sequencing_run_id": run_id, "irida_uploader_command": " ".join(irida_uploader_command)}))
+        _log.error({
+            "event_type": "upload_failed",
+            "sequencing_run_id": run_id,
+            "irida_uploader_command": irida_uploader_command_str,
+            "irida_uploader_output": list(irida_uploader_output_tail),
+        })
 
     if upload_successful:
         upload_parent_dir = os.path.dirname(upload_dir)
@@ -273,7 +859,7 @@ def upload_run(config, run):
             # Commented out 2023-11-06 by dfornika <dan.fornika@bccdc.ca>
             # for troubleshooting multiple-upload issue
             # shutil.rmtree(upload_parent_dir)
-            # logging.info(json.dumps({"event_type": "directory_deleted", "directory_path": upload_parent_dir}))
+            # _log.info({"event_type": "directory_deleted", "directory_path": upload_parent_dir})
             irida_upload_completed_path = os.path.join(upload_dir, 'irida_upload_completed.json')
             irida_upload_completed_contents = {}
             with open(irida_upload_completed_path, 'w') as f:
@@ -16,6 +16,11 @@ setup(
     install_requires=[
         'iridauploader>=0.9.0',
     ],
+    extras_require={
+        'blake3': ['blake3'],
+        'pyarrow': ['pyarrow'],
+        'orjson': ['orjson'],
+    },
     description='Automated upload of sequence data to IRIDA, using the irida-uploader tool.',
     url='https://github.com/BCCDC-PHL/auto-irida-uploader',
     author='Dan Fornika',